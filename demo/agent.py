@@ -1,14 +1,29 @@
 import asyncio
-import functools
 import json
 import logging
 import os
-import random
-import subprocess
+import secrets
+from urllib.parse import quote
 
-from aiohttp import web, ClientSession, ClientRequest, ClientError
+from aiohttp import web, ClientSession, ClientError, TCPConnector
 
-from .utils import flatten, log_json, log_msg, log_timer, output_reader
+from .utils import flatten, log_json, log_msg, log_timer
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(data) -> bytes:
+        return json.dumps(data).encode("utf-8")
+
+
+try:
+    import uvloop
+
+    uvloop.install()
+except ImportError:
+    pass
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,6 +33,19 @@ DEFAULT_EXTERNAL_HOST = "localhost"
 DEFAULT_BIN_PATH = "../bin"
 DEFAULT_PYTHON_PATH = ".."
 
+POSTGRES_STORAGE_CONFIG = (
+    '{{"url":"{host}:5432","tls":"None","max_connections":5,'
+    '"min_idle_time":0,"connection_timeout":10}}'
+)
+POSTGRES_STORAGE_CREDS = json_dumps(
+    {
+        "account": "postgres",
+        "password": "mysecretpassword",
+        "admin_account": "postgres",
+        "admin_password": "mysecretpassword",
+    }
+).decode()
+
 RUN_MODE = os.getenv("RUNMODE")
 
 if RUN_MODE == "docker":
@@ -44,7 +72,104 @@ async def default_genesis_txns():
     return genesis
 
 
+class AgentProcessProtocol(asyncio.SubprocessProtocol):
+    """Forward complete output lines from an agent process to its handlers."""
+
+    def __init__(self, agent: "DemoAgent", loop: asyncio.AbstractEventLoop):
+        self.handlers = {1: agent._handle_stdout, 2: agent._handle_stderr}
+        self.buffers = {1: bytearray(), 2: bytearray()}
+        self.exited = loop.create_future()
+
+    def pipe_data_received(self, fd: int, data: bytes):
+        buffer = self.buffers[fd]
+        buffer.extend(data)
+        end = buffer.rfind(b"\n") + 1
+        if end:
+            text = buffer[:end].decode("utf-8", "replace")
+            del buffer[:end]
+            handler = self.handlers[fd]
+            for line in text[:-1].split("\n"):
+                handler(line + "\n")
+
+    def pipe_connection_lost(self, fd: int, exc):
+        buffer = self.buffers[fd]
+        if buffer:
+            self.handlers[fd](buffer.decode("utf-8", "replace"))
+            buffer.clear()
+
+    def process_exited(self):
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+class WebhookHub:
+    """Single webhook listener shared by all agents in this process."""
+
+    def __init__(self):
+        self.handlers = {}
+        self.port = None
+        self.runner: web.AppRunner = None
+        self._start_lock: asyncio.Lock = None
+
+    async def start(self, port: int = None):
+        """Start listening on `port`, or join the listener already running."""
+        if not self._start_lock:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self.runner:
+                if port and port != self.port:
+                    raise Exception(
+                        f"Webhook listener is already running on port {self.port}"
+                    )
+                return
+            if not port:
+                raise Exception("A port is required to start the webhook listener")
+            app = web.Application()
+            app.add_routes(
+                [web.post("/webhooks/{agent}/topic/{topic}/", self._receive_webhook)]
+            )
+            runner = web.AppRunner(app)
+            await runner.setup()
+            try:
+                await web.TCPSite(runner, "0.0.0.0", port).start()
+            except Exception:
+                await runner.cleanup()
+                raise
+            self.runner = runner
+            self.port = port
+
+    def register(self, ident: str, handler):
+        if ident in self.handlers:
+            raise Exception(f"Webhook handler already registered for {ident}")
+        self.handlers[ident] = handler
+
+    async def unregister(self, ident: str, handler):
+        if self.handlers.get(ident) == handler:
+            del self.handlers[ident]
+        if not self.handlers and self.runner:
+            runner = self.runner
+            self.runner = None
+            self.port = None
+            await runner.cleanup()
+
+    async def _receive_webhook(self, request: web.Request):
+        handler = self.handlers.get(request.match_info["agent"])
+        if not handler:
+            raise web.HTTPNotFound()
+        topic = request.match_info["topic"]
+        payload = await request.json()
+        await handler(topic, payload)
+        return web.Response(text="")
+
+
+WEBHOOK_HUB = WebhookHub()
+
+
 class DemoAgent:
+    _client_session: ClientSession = None
+    _client_session_refs = 0
+    _base_env: dict = None
+
     def __init__(
         self,
         ident: str,
@@ -70,6 +195,7 @@ class DemoAgent:
         self.label = label or ident
         self.color = color
         self.prefix = prefix
+        self.prefix_str = f"{prefix:10s} |" if prefix else None
         self.timing = timing
         self.postgres = DEFAULT_POSTGRES if postgres is None else postgres
         self.extra_args = extra_args
@@ -78,15 +204,13 @@ class DemoAgent:
         self.admin_url = f"http://{self.external_host}:{admin_port}"
         self.webhook_port = None
         self.webhook_url = None
-        self.webhook_site = None
         self.params = params
         self.proc = None
-        self.client_session: ClientSession = ClientSession()
+        self.proc_protocol: AgentProcessProtocol = None
+        self.client_session: ClientSession = DemoAgent._get_session()
 
-        rand_name = str(random.randint(100_000, 999_999))
-        self.seed = (
-            params.get("seed") or ("my_seed_000000000000000000000000" + rand_name)[-32:]
-        )
+        rand_name = secrets.token_hex(3)
+        self.seed = params.get("seed") or ("my_seed_" + secrets.token_hex(12))
         self.storage_type = params.get("storage_type")
         self.wallet_type = params.get("wallet_type", "indy")
         self.wallet_name = params.get("wallet_name") or \
@@ -94,69 +218,85 @@ class DemoAgent:
         self.wallet_key = params.get("wallet_key") or self.ident + rand_name
         self.did = None
 
+    @classmethod
+    def _get_session(cls) -> ClientSession:
+        """Get the client session shared by all agents in this process."""
+        if not cls._client_session or cls._client_session.closed:
+            cls._client_session = ClientSession(
+                connector=TCPConnector(
+                    limit=0,
+                    limit_per_host=16,
+                    keepalive_timeout=120,
+                    ttl_dns_cache=300,
+                    enable_cleanup_closed=True,
+                    force_close=False,
+                )
+            )
+            cls._client_session_refs = 0
+        cls._client_session_refs += 1
+        return cls._client_session
+
+    @classmethod
+    async def _release_session(cls):
+        """Close the shared client session once the last agent is done with it."""
+        cls._client_session_refs -= 1
+        if cls._client_session_refs <= 0 and cls._client_session:
+            await cls._client_session.close()
+            cls._client_session = None
+            cls._client_session_refs = 0
+
     def get_agent_args(self):
         result = [
-            ("--endpoint", self.endpoint),
-            ("--label", self.label),
+            "--endpoint",
+            self.endpoint,
+            "--label",
+            self.label,
             "--auto-respond-messages",
             "--accept-invites",
             "--accept-requests",
             "--auto-ping-connection",
-            ("--inbound-transport", "http", "0.0.0.0", str(self.http_port)),
-            ("--outbound-transport", "http"),
-            ("--admin", "0.0.0.0", str(self.admin_port)),
-            ("--wallet-type", self.wallet_type),
-            ("--wallet-name", self.wallet_name),
-            ("--wallet-key", self.wallet_key),
-            ("--seed", self.seed),
+            "--inbound-transport",
+            "http",
+            "0.0.0.0",
+            str(self.http_port),
+            "--outbound-transport",
+            "http",
+            "--admin",
+            "0.0.0.0",
+            str(self.admin_port),
+            "--wallet-type",
+            self.wallet_type,
+            "--wallet-name",
+            self.wallet_name,
+            "--wallet-key",
+            self.wallet_key,
+            "--seed",
+            self.seed,
         ]
         if self.genesis_data:
-            result.append(("--genesis-transactions", self.genesis_data))
+            result.extend(("--genesis-transactions", self.genesis_data))
         if self.storage_type:
-            result.append(("--storage-type", self.storage_type))
+            result.extend(("--storage-type", self.storage_type))
         if self.timing:
             result.append("--timing")
         if self.postgres:
             result.extend(
-                [
-                    ("--wallet-storage-type", "postgres_storage"),
-                    (
-                        "--wallet-storage-config",
-                        json.dumps(
-                            {
-                                "url": f"{self.internal_host}:5432",
-                                "tls": "None",
-                                "max_connections": 5,
-                                "min_idle_time": 0,
-                                "connection_timeout": 10,
-                            }
-                        ),
-                    ),
-                    (
-                        "--wallet-storage-creds",
-                        json.dumps(
-                            {
-                                "account": "postgres",
-                                "password": "mysecretpassword",
-                                "admin_account": "postgres",
-                                "admin_password": "mysecretpassword",
-                            }
-                        ),
-                    ),
-                ]
+                (
+                    "--wallet-storage-type",
+                    "postgres_storage",
+                    "--wallet-storage-config",
+                    POSTGRES_STORAGE_CONFIG.format(host=self.internal_host),
+                    "--wallet-storage-creds",
+                    POSTGRES_STORAGE_CREDS,
+                )
             )
         if self.webhook_url:
-            result.append(("--webhook-url", self.webhook_url))
+            result.extend(("--webhook-url", self.webhook_url))
         if self.extra_args:
-            result.extend(self.extra_args)
+            result.extend(flatten(self.extra_args))
 
         return result
 
-    @property
-    def prefix_str(self):
-        if self.prefix:
-            return f"{self.prefix:10s} |"
-
     async def register_did(self, ledger_url: str = None, alias: str = None):
         self.log(f"Registering {self.ident} with seed {self.seed}")
         if not ledger_url:
@@ -171,15 +311,16 @@ class DemoAgent:
             self.did = nym_info["did"]
         self.log(f"Got DID: {self.did}")
 
-    def handle_output(self, *output, source: str = None, **kwargs):
-        end = "" if source else "\n"
-        if source == "stderr":
-            color = "fg:ansired"
-        elif not source:
-            color = self.color or "fg:ansiblue"
-        else:
-            color = None
-        log_msg(*output, color=color, prefix=self.prefix_str, end=end, **kwargs)
+    def handle_output(self, *output, **kwargs):
+        log_msg(
+            *output, color=self.color or "fg:ansiblue", prefix=self.prefix_str, **kwargs
+        )
+
+    def _handle_stdout(self, line: str):
+        log_msg(line, color=None, prefix=self.prefix_str, end="")
+
+    def _handle_stderr(self, line: str):
+        log_msg(line, color="fg:ansired", prefix=self.prefix_str, end="")
 
     def log(self, *msg, **kwargs):
         self.handle_output(*msg, **kwargs)
@@ -190,27 +331,11 @@ class DemoAgent:
     def log_timer(self, label: str, show: bool = True, **kwargs):
         return log_timer(label, show, logger=self.log, **kwargs)
 
-    def _process(self, args, env, loop):
-        proc = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env,
-            encoding="utf-8",
-        )
-        loop.run_in_executor(
-            None,
-            output_reader,
-            proc.stdout,
-            functools.partial(self.handle_output, source="stdout"),
-        )
-        loop.run_in_executor(
-            None,
-            output_reader,
-            proc.stderr,
-            functools.partial(self.handle_output, source="stderr"),
+    async def _process(self, args, env):
+        loop = asyncio.get_event_loop()
+        self.proc, self.proc_protocol = await loop.subprocess_exec(
+            lambda: AgentProcessProtocol(self, loop), *args, stdin=None, env=env
         )
-        return proc
 
     def get_process_args(self, bin_path: str = None):
         cmd_path = "acagent"
@@ -218,60 +343,60 @@ class DemoAgent:
             bin_path = DEFAULT_BIN_PATH
         if bin_path:
             cmd_path = os.path.join(bin_path, cmd_path)
-        return list(flatten((["python3", cmd_path], self.get_agent_args())))
+        return ["python3", cmd_path, *self.get_agent_args()]
 
     async def start_process(
         self, python_path: str = None, bin_path: str = None, wait: bool = True
     ):
-        my_env = os.environ.copy()
+        if DemoAgent._base_env is None:
+            DemoAgent._base_env = os.environ.copy()
         python_path = DEFAULT_PYTHON_PATH if python_path is None else python_path
         if python_path:
-            my_env["PYTHONPATH"] = python_path
+            my_env = {**DemoAgent._base_env, "PYTHONPATH": python_path}
+        else:
+            my_env = DemoAgent._base_env
 
         agent_args = self.get_process_args(bin_path)
 
         # start agent sub-process
-        loop = asyncio.get_event_loop()
-        self.proc = await loop.run_in_executor(
-            None, self._process, agent_args, my_env, loop
-        )
+        await self._process(agent_args, my_env)
         if wait:
             await self.detect_process()
 
-    def _terminate(self):
-        if self.proc and self.proc.poll() is None:
+    async def _terminate(self):
+        if self.proc and self.proc.get_returncode() is None:
             self.proc.terminate()
             try:
-                self.proc.wait(timeout=0.5)
-                self.log(f"Exited with return code {self.proc.returncode}")
-            except subprocess.TimeoutExpired:
+                await asyncio.wait_for(asyncio.shield(self.proc_protocol.exited), 0.5)
+                self.log(f"Exited with return code {self.proc.get_returncode()}")
+            except asyncio.TimeoutError:
                 msg = "Process did not terminate in time"
                 self.log(msg)
                 raise Exception(msg)
 
     async def terminate(self):
-        loop = asyncio.get_event_loop()
         if self.proc:
-            await loop.run_in_executor(None, self._terminate)
-        await self.client_session.close()
-        if self.webhook_site:
-            await self.webhook_site.stop()
-
-    async def listen_webhooks(self, webhook_port):
-        self.webhook_port = webhook_port
-        self.webhook_url = f"http://{self.external_host}:{str(webhook_port)}/webhooks"
-        app = web.Application()
-        app.add_routes([web.post("/webhooks/topic/{topic}/", self._receive_webhook)])
-        runner = web.AppRunner(app)
-        await runner.setup()
-        self.webhook_site = web.TCPSite(runner, "0.0.0.0", webhook_port)
-        await self.webhook_site.start()
-
-    async def _receive_webhook(self, request: ClientRequest):
-        topic = request.match_info["topic"]
-        payload = await request.json()
-        await self.handle_webhook(topic, payload)
-        return web.Response(text="")
+            await self._terminate()
+            self.proc.close()
+        if self.client_session:
+            self.client_session = None
+            await DemoAgent._release_session()
+        if self.webhook_url:
+            self.webhook_url = None
+            await WEBHOOK_HUB.unregister(self.ident, self.handle_webhook)
+
+    async def listen_webhooks(self, webhook_port: int = None):
+        WEBHOOK_HUB.register(self.ident, self.handle_webhook)
+        try:
+            await WEBHOOK_HUB.start(webhook_port)
+        except Exception:
+            await WEBHOOK_HUB.unregister(self.ident, self.handle_webhook)
+            raise
+        self.webhook_port = WEBHOOK_HUB.port
+        self.webhook_url = (
+            f"http://{self.external_host}:{str(self.webhook_port)}"
+            f"/webhooks/{quote(self.ident, safe='')}"
+        )
 
     async def handle_webhook(self, topic: str, payload):
         if topic != "webhook":  # would recurse
@@ -280,20 +405,27 @@ class DemoAgent:
                 await method(payload)
 
     async def admin_request(self, method, path, data=None, text=False):
+        if data is not None:
+            data = json_dumps(data)
+            headers = {"Content-Type": "application/json"}
+        else:
+            headers = None
         async with self.client_session.request(
-            method, self.admin_url + path, json=data
+            method, self.admin_url + path, data=data, headers=headers
         ) as resp:
             if resp.status < 200 or resp.status > 299:
                 raise Exception(f"Unexpected HTTP response: {resp.status}")
-            resp_text = await resp.text()
-            if not resp_text and not text:
+            raw = await resp.read()
+            if text:
+                return raw.decode("utf-8")
+            if not raw:
                 return None
-            if not text:
-                try:
-                    return json.loads(resp_text)
-                except json.JSONDecodeError as e:
-                    raise Exception(f"Error decoding JSON: {resp_text}") from e
-            return resp_text
+            try:
+                return json_loads(raw)
+            except json.JSONDecodeError as e:
+                raise Exception(
+                    f"Error decoding JSON: {raw.decode('utf-8', 'replace')}"
+                ) from e
 
     async def admin_GET(self, path, text=False):
         return await self.admin_request("GET", path, None, text)
@@ -302,23 +434,28 @@ class DemoAgent:
         return await self.admin_request("POST", path, data, text)
 
     async def detect_process(self):
-        text = None
-        for i in range(10):
+        marker = b"Aries Cloud Agent"
+        body = None
+        delay = 0.1
+        waited = 0.0
+        while waited < 20.0:
             # wait for process to start and retrieve swagger content
-            await asyncio.sleep(2.0)
+            await asyncio.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 2.0)
             try:
                 async with self.client_session.get(
                     self.admin_url + "/api/docs/swagger.json"
                 ) as resp:
                     if resp.status == 200:
-                        text = await resp.text()
+                        body = await resp.read()
                         break
             except ClientError:
-                text = None
+                body = None
                 continue
-        if not text:
+        if not body:
             raise Exception(f"Timed out waiting for agent process to start")
-        if "Aries Cloud Agent" not in text:
+        if marker not in body:
             raise Exception(f"Unexpected response from agent process")
 
     async def fetch_timing(self):
@@ -326,19 +463,17 @@ class DemoAgent:
         return status.get("timing")
 
     def format_timing(self, timing: dict) -> dict:
-        result = []
-        for name, count in timing["count"].items():
-            result.append(
-                (
-                    name[:35],
-                    count,
-                    timing["total"][name],
-                    timing["avg"][name],
-                    timing["min"][name],
-                    timing["max"][name],
-                )
-            )
-        result.sort(key=lambda row: row[2], reverse=True)
+        counts = timing["count"]
+        names = list(counts)
+        columns = [
+            [timing[key][name] for name in names]
+            for key in ("total", "avg", "min", "max")
+        ]
+        result = sorted(
+            zip((name[:35] for name in names), counts.values(), *columns),
+            key=lambda row: row[2],
+            reverse=True,
+        )
         yield "{:35} | {:>12} {:>12} {:>10} {:>10} {:>10}".format(
             "", "count", "total", "avg", "min", "max"
         )
@@ -138,7 +138,8 @@ async def main():
         await alice.register_did()
 
         faber = FaberAgent(start_port + 4, genesis_data=genesis)
-        await faber.listen_webhooks(start_port + 6)
+        # faber shares the webhook listener started for alice
+        await faber.listen_webhooks()
         await faber.register_did()
 
         with log_timer("Startup duration:"):
@@ -1,4 +1,3 @@
-import functools
 import json
 import os
 from timeit import default_timer
@@ -107,13 +106,6 @@ def print_ext(
     print(*msg, **kwargs)
 
 
-def output_reader(handle, callback, *args, **kwargs):
-    for line in iter(handle.readline, b""):
-        if not line:
-            break
-        run_in_terminal(functools.partial(callback, line, *args))
-
-
 def log_msg(*msg, color="fg:ansimagenta", **kwargs):
     run_in_terminal(lambda: print_ext(*msg, color=color, **kwargs))
 